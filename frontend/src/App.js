@@ -4558,6 +4558,9 @@ const CustomerSegmentation = () => {
   const [loading, setLoading] = useState(true);
   const [selectedSegment, setSelectedSegment] = useState(null);
   const [showCustomersModal, setShowCustomersModal] = useState(false);
+  const [segmentCustomers, setSegmentCustomers] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [loadingCustomers, setLoadingCustomers] = useState(false);
   const { adminToken } = useAuth();
 
   useEffect(() => {
@@ -4567,8 +4570,10 @@ const CustomerSegmentation = () => {
   const fetchSegmentationData = async () => {
     try {
       setLoading(true);
+      // Summary only - customers are fetched a page at a time per segment
       const response = await axios.get(`${API}/admin/customer-segmentation`, {
-        headers: { Authorization: `Bearer ${adminToken}` }
+        headers: { Authorization: `Bearer ${adminToken}` },
+        params: { limit: 0 }
       });
       setSegmentationData(response.data);
     } catch (error) {
@@ -4578,14 +4583,28 @@ const CustomerSegmentation = () => {
     }
   };
 
+  const fetchSegmentCustomers = async (segment, cursor = null) => {
+    try {
+      setLoadingCustomers(true);
+      const response = await axios.get(`${API}/admin/customer-segmentation`, {
+        headers: { Authorization: `Bearer ${adminToken}` },
+        params: { segment: segment.name, limit: 50, ...(cursor ? { cursor } : {}) }
+      });
+      setSegmentCustomers(previous => cursor ? [...previous, ...response.data.customers] : response.data.customers);
+      setNextCursor(response.data.next_cursor);
+    } catch (error) {
+      console.error('Error fetching segment customers:', error);
+    } finally {
+      setLoadingCustomers(false);
+    }
+  };
+
   const handleSegmentClick = (segment) => {
     setSelectedSegment(segment);
+    setSegmentCustomers([]);
+    setNextCursor(null);
     setShowCustomersModal(true);
-  };
-
-  const getSegmentCustomers = () => {
-    if (!selectedSegment || !segmentationData) return [];
-    return segmentationData.customers.filter(c => c.segment === selectedSegment.name);
+    fetchSegmentCustomers(segment);
   };
 
   if (loading) {
@@ -4767,7 +4786,7 @@ const CustomerSegmentation = () => {
                   </tr>
                 </thead>
                 <tbody className="bg-white divide-y divide-gray-200">
-                  {getSegmentCustomers().slice(0, 50).map((customer, index) => (
+                  {segmentCustomers.map((customer, index) => (
                     <tr key={customer.customer_id} className="hover:bg-gray-50">
                       <td className="px-4 py-4 whitespace-nowrap">
                         <div className="text-sm font-medium text-gray-900">
@@ -4797,11 +4816,18 @@ const CustomerSegmentation = () => {
                   ))}
                 </tbody>
               </table>
-              {getSegmentCustomers().length > 50 && (
-                <div className="p-4 text-center text-gray-500 text-sm">
-                  Mostrati primi 50 clienti di {getSegmentCustomers().length}
-                </div>
-              )}
+              <div className="p-4 text-center text-gray-500 text-sm">
+                Mostrati {segmentCustomers.length} clienti di {selectedSegment.count}
+                {nextCursor && (
+                  <button
+                    onClick={() => fetchSegmentCustomers(selectedSegment, nextCursor)}
+                    disabled={loadingCustomers}
+                    className="ml-4 px-4 py-1 bg-imagross-orange text-white rounded-lg hover:bg-imagross-red transition-colors disabled:opacity-50"
+                  >
+                    {loadingCustomers ? 'Caricamento...' : 'Carica altri'}
+                  </button>
+                )}
+              </div>
             </div>
 
             <div className="mt-6 flex justify-end">
@@ -0,0 +1,689 @@
+#!/usr/bin/env python3
+"""
+ImaGross Ingestion Benchmark
+Measures the backend loaders on synthetic exports and records a JSON baseline
+
+Each loader runs in its own process against a local mongod (--mongo-url) or
+an in-process stand-in, and reports rows/sec, peak RSS and event-loop stall:
+
+    python ingestion_benchmark.py                                  # 10k and 100k rows, stand-in
+    python ingestion_benchmark.py --sizes 1M,10M --mongo-url mongodb://localhost:27017
+    python ingestion_benchmark.py --compare ingestion_benchmark_baseline.json
+
+The rollup rebuild and customer RFM passes that follow a load are timed as
+separate phases against mongod; on the stand-in they are reported as skipped.
+
+With --compare the run exits with status 1 when a loader got slower, or
+used more memory or blocked the loop for longer, than the baseline allows.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.join(ROOT_DIR, "backend")
+DEFAULT_BASELINE = os.path.join(ROOT_DIR, "ingestion_benchmark_baseline.json")
+DEFAULT_DATA_DIR = os.path.join(tempfile.gettempdir(), "imagross_ingest_benchmark")
+
+SIZES = {"10k": 10_000, "100k": 100_000, "1M": 1_000_000, "10M": 10_000_000}
+LOADERS = ("fidelity", "scontrini", "vendite", "parse_json_tolerant")
+# File each loader reads, under the name the backend looks for
+SOURCE_FILES = {
+    "fidelity": "fidelity_complete.json",
+    "scontrini": "SCONTRINI_da_Gen2025.json",
+    "vendite": "Vendite_20250101_to_20250630.json",
+    "parse_json_tolerant": "fidelity_complete.json",
+}
+
+DUPLICATE_RECEIPT_RATE = 0.01  # Receipts exported twice, as the real TECLI files have
+STALL_SAMPLE_SECONDS = 0.01
+STALL_THRESHOLD_SECONDS = 0.05  # Lags above this count towards stall_total_ms
+RESULT_MARKER = "BENCHMARK_RESULT "
+# Work past the insert itself, timed on its own after each loader. It runs
+# $group pipelines over the raw rows, which the stand-in doesn't keep, so
+# without --mongo-url these phases are reported as skipped
+LOADER_PHASES = {
+    "scontrini": ("rollup_rebuild", "customer_rfm"),
+    "vendite": ("rollup_rebuild",),
+}
+SKIPPED_PHASE_REASON = "needs --mongo-url: the in-process stand-in keeps only the _id of raw rows"
+
+# ============================================================================
+# SYNTHETIC EXPORTS
+# ============================================================================
+
+FIRST_NAMES = ["GIUSEPPINA", "CHIARA", "NICOLÒ", "MARIA", "FRANCESCO", "ANTONIO", "ROSA", "VITO", "ANNA", "LUCA"]
+LAST_NAMES = ["VASTO", "ABATANGELO", "D'ANNUNZIO", "DE SANTIS", "LORUSSO", "COLELLA", "GIANNUZZI", "PETRUZZELLI"]
+STREETS = ["VIA G. DI VITTORIO", "VIA G. D'ANNUNZIO", "CORSO ITALIA", "VIA S. FRANCESCO", "PIAZZA XX SETTEMBRE"]
+TOWNS = ["MOLA", "BARI", "CONVERSANO", "RUTIGLIANO", "POLIGNANO"]
+PRODUCTS = ["LATTE INTERO 1L", "PASTA SEMOLA 500G", "OLIO EVO 1L", "PANE CASERECCIO", "MOZZARELLA 125G",
+            "CAFFE' MACINATO 250G", "ACQUA NAT. 6X1,5L", "POMODORI PELATI 400G"]
+
+def _day(rng: random.Random) -> str:
+    return f"2025{rng.randint(1, 6):02d}{rng.randint(1, 28):02d}"
+
+def _malform(line: str, rng: random.Random) -> str:
+    """Break a fidelity line the ways the real export is broken"""
+    kind = rng.randrange(3)
+    if kind == 0:
+        # Invalid escape inside a value: "S.\\ MARIA" written as "S.\ MARIA"
+        return line.replace('"indirizzo" : "', '"indirizzo" : "S.\\ ', 1)
+    if kind == 1:
+        # Backslash right before the closing quote of a value
+        return line.replace('",\n\t\t"cap"', '\\",\n\t\t"cap"', 1)
+    # Trailing comma before the closing brace
+    return line.replace('"ragione_sociale" : ""\n', '"ragione_sociale" : "",\n', 1)
+
+def write_fidelity_file(path: str, rows: int, malformed_rate: float, seed: int):
+    """Fidelity export: one card per object, decimal commas, YYYYMMDD dates, 0/1 flags"""
+    rng = random.Random(seed)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("[\n")
+        for i in range(rows):
+            card = f"20200{i:08d}"
+            line = (
+                "\t{\n"
+                f'\t\t"card_number" : "{card}",\n'
+                f'\t\t"tessera_fisica" : "{card}",\n'
+                f'\t\t"cognome" : "{rng.choice(LAST_NAMES)}",\n'
+                f'\t\t"nome" : "{rng.choice(FIRST_NAMES)}",\n'
+                f'\t\t"stato_tes" : "01",\n'
+                f'\t\t"indirizzo" : "{rng.choice(STREETS)} N.{rng.randint(1, 200)}",\n'
+                f'\t\t"cap" : "700{rng.randint(10, 99)}",\n'
+                f'\t\t"localita" : "{rng.choice(TOWNS)}",\n'
+                f'\t\t"provincia" : "BA",\n'
+                f'\t\t"n_telefono" : "34{rng.randint(0, 99999999):08d}",\n'
+                f'\t\t"data_creazione" : "{rng.randint(2015, 2024)}{rng.randint(1, 12):02d}{rng.randint(1, 28):02d}",\n'
+                f'\t\t"data_nas" : "19{rng.randint(40, 99)}{rng.randint(1, 12):02d}{rng.randint(1, 28):02d}",\n'
+                f'\t\t"sesso" : "{rng.choice("FM")}",\n'
+                f'\t\t"email" : "",\n'
+                f'\t\t"negozio" : "{rng.randint(1, 12)}",\n'
+                f'\t\t"dati_pers" : "1",\n'
+                f'\t\t"dati_pubb" : "{rng.randint(0, 1)}",\n'
+                f'\t\t"profilazione" : "{rng.randint(0, 1)}",\n'
+                f'\t\t"marketing" : "{rng.randint(0, 1)}",\n'
+                f'\t\t"data_ult_sc" : "{_day(rng)}",\n'
+                f'\t\t"prog_spesa" : "{rng.randint(0, 4999)},{rng.randint(0, 99):02d}",\n'
+                f'\t\t"bollini" : "{rng.randint(0, 3000)}",\n'
+                f'\t\t"coniugato" : "",\n'
+                f'\t\t"numero_figli" : "",\n'
+                f'\t\t"lattosio" : "",\n'
+                f'\t\t"glutine" : "",\n'
+                f'\t\t"ragione_sociale" : ""\n'
+                "\t}"
+            )
+            if rng.random() < malformed_rate:
+                line = _malform(line, rng)
+            f.write(line)
+            f.write(",\n" if i < rows - 1 else "\n")
+        f.write("]\n")
+
+def write_scontrini_file(path: str, rows: int, seed: int):
+    """TECLI export: receipts under a top-level key, a share of them exported twice"""
+    rng = random.Random(seed)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('{\n"TECLI": [\n')
+        line = None
+        for i in range(rows):
+            if line is None or rng.random() >= DUPLICATE_RECEIPT_RATE:
+                amount = rng.randint(100, 25000) / 100
+                line = (
+                    "\t{\n"
+                    f'\t\t"CODICE_CLIENTE" : "2013{rng.randint(0, 99999):09d}",\n'
+                    f'\t\t"DITTA" : "{rng.randint(1, 12)}",\n'
+                    f'\t\t"DATA_SCONTRINO" : "{_day(rng)}",\n'
+                    f'\t\t"ORA_SCONTRINO" : {rng.randint(8, 20)}{rng.randint(0, 59):02d},\n'
+                    f'\t\t"IMPORTO_SCONTRINO" : {amount:.3f},\n'
+                    f'\t\t"NUMERO_CASSA" : "{rng.randint(1, 6)}",\n'
+                    f'\t\t"TIPO_PAGAM1" : "0{rng.randint(1, 5)}",\n'
+                    f'\t\t"TIPO_PAGAM2" : "",\n'
+                    f'\t\t"N_BOLLINI" : {int(amount):.3f}\n'
+                    "\t}"
+                )
+            f.write(line)
+            f.write(",\n" if i < rows - 1 else "\n")
+        f.write("]\n}\n")
+
+def write_vendite_file(path: str, rows: int, seed: int):
+    """Vendite export: one sold line per object in a top-level array"""
+    rng = random.Random(seed)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("[\n")
+        for i in range(rows):
+            quantity = rng.randint(1, 6)
+            amount = quantity * rng.randint(50, 2000) / 100
+            f.write(
+                "{"
+                f'"DATA_VENDITA":"{_day(rng)}",'
+                f'"CODICE_CLIENTE":"2013{rng.randint(0, 99999):09d}",'
+                f'"BARCODE":"80{rng.randint(0, 20000):011d}",'
+                f'"DESCRIZIONE":"{rng.choice(PRODUCTS)}",'
+                f'"TOT_QNT":{quantity:.3f},'
+                f'"TOT_IMPORTO":{amount:.3f},'
+                f'"TOT_BOLLINI":{int(amount)},'
+                f'"REPARTO":"{rng.randint(1, 18):02d}",'
+                f'"NEGOZIO":"{rng.randint(1, 12)}"'
+                "}"
+            )
+            f.write(",\n" if i < rows - 1 else "\n")
+        f.write("]\n")
+
+def ensure_source_file(data_dir: str, loader: str, rows: int, malformed_rate: float, seed: int) -> str:
+    """Generate (or reuse) the synthetic export a loader reads; returns its path"""
+    kind = "fidelity" if loader == "parse_json_tolerant" else loader
+    suffix = f"_{malformed_rate:g}" if kind == "fidelity" else ""
+    path = os.path.join(data_dir, f"{kind}_{rows}{suffix}_{seed}.json")
+    if os.path.exists(path):
+        return path
+
+    print(f"🧪 Generating {rows:,} {kind} rows -> {path}")
+    started = time.perf_counter()
+    partial = f"{path}.partial"
+    if kind == "fidelity":
+        write_fidelity_file(partial, rows, malformed_rate, seed)
+    elif kind == "scontrini":
+        write_scontrini_file(partial, rows, seed)
+    else:
+        write_vendite_file(partial, rows, seed)
+    os.replace(partial, path)
+    print(f"   {os.path.getsize(path) / 1024 / 1024:,.1f} MB in {time.perf_counter() - started:.1f}s")
+    return path
+
+# ============================================================================
+# IN-PROCESS MONGO STAND-IN
+# ============================================================================
+
+class _MemoryCursor:
+    def __init__(self, docs, run=None):
+        self._docs = docs
+        self._run = run  # Work a pipeline does server-side ($out), done on the first read
+
+    def _execute(self):
+        if self._run is not None:
+            self._run()
+            self._run = None
+
+    def sort(self, *args, **kwargs):
+        return self
+
+    def limit(self, n):
+        self._docs = self._docs[:n] if n else self._docs
+        return self
+
+    async def to_list(self, length=None):
+        self._execute()
+        return list(self._docs if length is None else self._docs[:length])
+
+    def __aiter__(self):
+        self._execute()
+        self._iter = iter(self._docs)
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._iter)
+        except StopIteration:
+            raise StopAsyncIteration
+
+class MemoryCollection:
+    """The slice of the Motor collection API the loaders use, kept in memory.
+
+    Writes run in a worker thread and BSON-encode every document, as Motor
+    does. Plain inserts only keep their _id (duplicate keys still fail with
+    code 11000) so the stand-in's own footprint stays small next to the
+    loader's; upserted documents (rollups, checkpoints) are kept whole.
+    """
+
+    def __init__(self, database, name: str):
+        self.database = database
+        self.name = name
+        self.ids = set()
+        self.documents = {}
+        self.indexes = []
+
+    def _match_ids(self, query: dict) -> list:
+        if not query:
+            return list(self.ids)
+        key = query.get("_id")
+        if isinstance(key, dict) and "$in" in key:
+            return [value for value in map(_document_key, key["$in"]) if value in self.ids]
+        key = _document_key(key)
+        return [key] if key in self.ids else []
+
+    def _insert(self, docs, ordered: bool):
+        from bson import ObjectId, encode
+        inserted, errors = [], []
+        for index, doc in enumerate(docs):
+            doc.setdefault("_id", ObjectId())
+            encode(doc)
+            if doc["_id"] in self.ids:
+                errors.append({"index": index, "code": 11000, "errmsg": "duplicate key error"})
+                if ordered:
+                    break
+                continue
+            self.ids.add(doc["_id"])
+            inserted.append(doc["_id"])
+        self.database.touch(self)
+        return inserted, errors
+
+    def _apply_update(self, _id, update: dict, upsert: bool, replace: bool = False) -> bool:
+        """Apply one update to the document with this _id; True when it was inserted"""
+        from bson import encode
+        encode(update)
+        key = _document_key(_id)
+        exists = key in self.ids
+        if not exists and not upsert:
+            return False
+        # Documents keep the _id as given - rollup and sketch _ids read back as documents
+        if replace:
+            self.documents[key] = dict(update, _id=_id)
+        else:
+            doc = self.documents.setdefault(key, {"_id": _id})
+            if not exists:
+                doc.update(update.get("$setOnInsert", {}))
+            doc.update(update.get("$set", {}))
+            for field, amount in update.get("$inc", {}).items():
+                doc[field] = doc.get(field, 0) + amount
+        self.ids.add(key)
+        self.database.touch(self)
+        return not exists
+
+    def _bulk_write(self, operations, ordered: bool):
+        from pymongo import InsertOne, ReplaceOne, UpdateOne
+        upserted_ids = {}
+        inserted = 0
+        for index, operation in enumerate(operations):
+            if isinstance(operation, InsertOne):
+                inserted += len(self._insert([operation._doc], ordered)[0])
+                continue
+            if not isinstance(operation, (ReplaceOne, UpdateOne)):
+                raise NotImplementedError(f"{type(operation).__name__} is not supported by the stand-in")
+            if self._apply_update(operation._filter["_id"], operation._doc, operation._upsert, isinstance(operation, ReplaceOne)):
+                upserted_ids[index] = operation._filter["_id"]
+        return SimpleNamespace(inserted_count=inserted, upserted_ids=upserted_ids, upserted_count=len(upserted_ids))
+
+    async def insert_many(self, docs, ordered: bool = True, **kwargs):
+        from pymongo.errors import BulkWriteError
+        inserted, errors = await asyncio.to_thread(self._insert, docs, ordered)
+        if errors:
+            raise BulkWriteError({"nInserted": len(inserted), "writeErrors": errors})
+        return SimpleNamespace(inserted_ids=inserted)
+
+    async def insert_one(self, doc, **kwargs):
+        await self.insert_many([doc])
+        return SimpleNamespace(inserted_id=doc["_id"])
+
+    async def bulk_write(self, operations, ordered: bool = True, **kwargs):
+        return await asyncio.to_thread(self._bulk_write, operations, ordered)
+
+    async def update_one(self, query, update, upsert: bool = False, **kwargs):
+        await asyncio.to_thread(self._apply_update, query["_id"], update, upsert)
+        return SimpleNamespace(matched_count=1, modified_count=1)
+
+    async def find_one(self, query=None, *args, **kwargs):
+        for key in self._match_ids(query or {}):
+            return self.documents.get(key, {"_id": key})
+        return None
+
+    def find(self, query=None, *args, **kwargs):
+        return _MemoryCursor([self.documents.get(key, {"_id": key}) for key in self._match_ids(query or {})])
+
+    def _copy_to(self, name: str):
+        """$out of the whole collection: the target is replaced, its old indexes kept"""
+        target = self.database[name]
+        target.ids, target.documents = set(self.ids), dict(self.documents)
+        self.database.touch(target)
+
+    def aggregate(self, pipeline, **kwargs):
+        """Whole-collection copies ([{"$match": {}}, {"$out": name}]), as the collection swap makes.
+
+        Any other pipeline groups raw rows, which plain inserts don't keep
+        here; the phases that need one are in LOADER_PHASES.
+        """
+        stages = [stage for stage in pipeline if stage != {"$match": {}}]
+        if len(stages) == 1 and list(stages[0]) == ["$out"]:
+            return _MemoryCursor([], run=lambda: self._copy_to(stages[0]["$out"]))
+        raise NotImplementedError(f"{SKIPPED_PHASE_REASON} ({', '.join(next(iter(stage)) for stage in stages)})")
+
+    async def delete_one(self, query, **kwargs):
+        return await self.delete_many(query)
+
+    async def delete_many(self, query, **kwargs):
+        keys = self._match_ids(query or {})
+        for key in keys:
+            self.ids.discard(key)
+            self.documents.pop(key, None)
+        return SimpleNamespace(deleted_count=len(keys))
+
+    async def count_documents(self, query=None, **kwargs):
+        return len(self._match_ids(query or {}))
+
+    async def estimated_document_count(self, **kwargs):
+        return len(self.ids)
+
+    async def create_index(self, keys, **kwargs):
+        self.indexes.append((keys, kwargs))
+        self.database.touch(self)
+        return kwargs.get("name") or str(keys)
+
+    async def drop(self):
+        self.ids, self.documents, self.indexes = set(), {}, []
+        if self.database.collections.get(self.name) is self:
+            del self.database.collections[self.name]
+
+    async def rename(self, new_name: str, dropTarget: bool = False, **kwargs):
+        if self.database.collections.get(self.name) is self:
+            del self.database.collections[self.name]
+        self.name = new_name
+        self.database.collections[new_name] = self
+
+def _document_key(key):
+    """Hashable form of an _id (rollup _ids are documents)"""
+    return tuple(sorted(key.items())) if isinstance(key, dict) else key
+
+class MemoryDatabase:
+    """Stand-in for the Motor database object the backend keeps in server.db"""
+
+    def __init__(self):
+        self.collections = {}
+        self._handles = {}
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        collection = self.collections.get(name)
+        if collection is None:
+            collection = self._handles.get(name)
+            if collection is None or collection.name != name:
+                collection = self._handles[name] = MemoryCollection(self, name)
+        return collection
+
+    def __getattr__(self, name: str) -> MemoryCollection:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def touch(self, collection: MemoryCollection):
+        """Writes create the collection, as they do in MongoDB"""
+        if self.collections.get(collection.name) is not collection:
+            self.collections[collection.name] = collection
+            self._handles.pop(collection.name, None)
+
+    async def list_collection_names(self, **kwargs):
+        return list(self.collections)
+
+# ============================================================================
+# MEASUREMENT
+# ============================================================================
+
+class LoopStallMonitor:
+    """Sample how late the event loop wakes up while a loader runs"""
+
+    def __init__(self, interval: float = STALL_SAMPLE_SECONDS):
+        self.interval = interval
+        self.lags = []
+        self._task = None
+        self.stopped = False
+
+    async def _sample(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.perf_counter() - started - self.interval))
+
+    def start(self):
+        self._task = asyncio.create_task(self._sample())
+
+    async def stop(self) -> dict:
+        self.stopped = True
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        lags = sorted(self.lags) or [0.0]
+        return {
+            "stall_max_ms": round(lags[-1] * 1000, 1),
+            "stall_p99_ms": round(lags[min(len(lags) - 1, int(len(lags) * 0.99))] * 1000, 1),
+            "stall_total_ms": round(sum(lag for lag in lags if lag > STALL_THRESHOLD_SECONDS) * 1000, 1),
+        }
+
+def peak_rss_mb(who: int = resource.RUSAGE_SELF) -> float:
+    # ru_maxrss is in KB on Linux, bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return round(resource.getrusage(who).ru_maxrss / scale, 1)
+
+async def run_loader(loader: str, source_path: str, mongo_url: str = None) -> dict:
+    """Run one loader against a fresh database and measure it (inside the child process)"""
+    sys.path.insert(0, BACKEND_DIR)
+    import server
+
+    mongo_client = None
+    if mongo_url:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        mongo_client = AsyncIOMotorClient(mongo_url)
+        database_name = f"ingest_benchmark_{os.getpid()}"
+        server.client = mongo_client
+        server.db = mongo_client[database_name]
+    else:
+        server.db = MemoryDatabase()
+
+        async def customer_rfm_skipped(customer_ids=None):
+            pass
+        # The receipt loader refreshes customer_rfm itself; that pass is a skipped phase here
+        server.refresh_customer_rfm = customer_rfm_skipped
+
+    collection = {"fidelity": "fidelity_data", "scontrini": "scontrini_data", "vendite": "vendite_data"}.get(loader)
+    job = server.IngestJob(collection) if collection else None
+    monitor = LoopStallMonitor()
+    monitor.start()
+    started = time.perf_counter()
+    try:
+        if loader == "fidelity":
+            await server.load_fidelity_to_database(mode="full", job=job)
+        elif loader == "scontrini":
+            await server.load_scontrini_to_database(mode="full", job=job)
+        elif loader == "vendite":
+            await server.load_vendite_to_database(job=job)
+        else:
+            records = await asyncio.to_thread(server.parse_json_tolerant, source_path)
+        elapsed = time.perf_counter() - started
+        stall = await monitor.stop()
+        phases = {}
+        for phase in LOADER_PHASES.get(loader, ()):
+            phases[phase] = await run_phase(server, phase, collection) if mongo_url else {
+                "status": "skipped", "reason": SKIPPED_PHASE_REASON,
+            }
+    finally:
+        if not monitor.stopped:
+            await monitor.stop()
+        if mongo_client is not None:
+            await mongo_client.drop_database(database_name)
+
+    if job is not None:
+        rows = job.rows_written
+        status = server.DATA_LOADING_STATUS.get(loader, job.status)
+        if job.error:
+            status = f"{status}: {job.error}"
+    else:
+        rows = len(records)
+        status = "parsed"
+    return {
+        "loader": loader,
+        "rows": rows,
+        "seconds": round(elapsed, 2),
+        "rows_per_sec": round(rows / elapsed, 1) if elapsed > 0 else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+        "peak_rss_workers_mb": peak_rss_mb(resource.RUSAGE_CHILDREN),
+        **stall,
+        "status": status,
+        "phases": phases,
+    }
+
+async def run_phase(server, phase: str, collection: str) -> dict:
+    """Time one post-load phase against the rows the loader just stored"""
+    monitor = LoopStallMonitor()
+    monitor.start()
+    started = time.perf_counter()
+    if phase == "rollup_rebuild":
+        await server.rebuild_rollups(collection)
+    else:
+        await server.rebuild_customer_rfm()
+    elapsed = time.perf_counter() - started
+    return {"status": "measured", "seconds": round(elapsed, 2), **await monitor.stop()}
+
+def run_child(loader: str, source_path: str, mongo_url: str = None) -> dict:
+    """Run one measurement in a separate process so peak RSS is the loader's own"""
+    work_dir = tempfile.mkdtemp(prefix="imagross_bench_")
+    # The loaders look the export up by name, in the working directory or VENDITE_DATA_DIR
+    os.symlink(source_path, os.path.join(work_dir, SOURCE_FILES[loader]))
+    env = dict(os.environ, VENDITE_DATA_DIR=work_dir, SNAPSHOT_DIR=os.path.join(work_dir, "snapshots"))
+    command = [sys.executable, os.path.abspath(__file__), "--child", loader, "--source", source_path]
+    if mongo_url:
+        command += ["--mongo-url", mongo_url]
+    try:
+        result = subprocess.run(command, cwd=work_dir, env=env, capture_output=True, text=True)
+    finally:
+        # rmtree removes the symlink, never the generated export it points to
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    for line in reversed(result.stdout.splitlines()):
+        if line.startswith(RESULT_MARKER):
+            return json.loads(line[len(RESULT_MARKER):])
+    tail = "\n".join((result.stdout + result.stderr).splitlines()[-20:])
+    raise RuntimeError(f"{loader} benchmark failed (exit {result.returncode}):\n{tail}")
+
+# ============================================================================
+# BASELINE
+# ============================================================================
+
+def result_key(result: dict) -> tuple:
+    return (result["loader"], result["input_rows"])
+
+def compare_with_baseline(results: list, baseline: dict, tolerance: float) -> list:
+    """Regressions against a saved baseline: slower, bigger, or stalling the loop for longer"""
+    previous = {result_key(result): result for result in baseline.get("results", [])}
+    regressions = []
+    for result in results:
+        before = previous.get(result_key(result))
+        if not before:
+            continue
+        label = f"{result['loader']} @ {result['input_rows']:,}"
+        if result["rows_per_sec"] < before["rows_per_sec"] * (1 - tolerance):
+            regressions.append(f"{label}: {result['rows_per_sec']:,.0f} rows/sec (baseline {before['rows_per_sec']:,.0f})")
+        if result["peak_rss_mb"] > before["peak_rss_mb"] * (1 + tolerance):
+            regressions.append(f"{label}: peak RSS {result['peak_rss_mb']:,.0f} MB (baseline {before['peak_rss_mb']:,.0f})")
+        # A few ms of scheduling noise is not a regression
+        if result["stall_max_ms"] > before["stall_max_ms"] * (1 + tolerance) + STALL_THRESHOLD_SECONDS * 1000:
+            regressions.append(f"{label}: loop stall {result['stall_max_ms']:,.0f} ms (baseline {before['stall_max_ms']:,.0f})")
+    return regressions
+
+def parse_sizes(value: str) -> list:
+    sizes = []
+    for size in value.split(","):
+        size = size.strip()
+        sizes.append(SIZES[size] if size in SIZES else int(size.replace("_", "")))
+    return sizes
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ImaGross ingestion loaders on synthetic exports")
+    parser.add_argument("--sizes", default="10k,100k", help="Row counts: 10k,100k,1M,10M or plain numbers")
+    parser.add_argument("--loaders", default=",".join(LOADERS), help=f"Subset of {','.join(LOADERS)}")
+    parser.add_argument("--malformed-rate", type=float, default=0.001,
+                        help="Share of fidelity records written with the export's broken escapes")
+    parser.add_argument("--seed", type=int, default=2025)
+    parser.add_argument("--mongo-url", default=os.environ.get("BENCHMARK_MONGO_URL"),
+                        help="Local mongod to load into (a throwaway database); default is the in-process stand-in")
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR, help="Where generated exports are kept and reused")
+    parser.add_argument("--output", default=DEFAULT_BASELINE, help="JSON file the results are written to")
+    parser.add_argument("--compare", help="Baseline JSON to check the results against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression (0.2 = 20%%)")
+    parser.add_argument("--child", choices=LOADERS, help=argparse.SUPPRESS)
+    parser.add_argument("--source", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        result = asyncio.run(run_loader(args.child, args.source, args.mongo_url))
+        print(RESULT_MARKER + json.dumps(result))
+        return
+
+    loaders = [loader.strip() for loader in args.loaders.split(",") if loader.strip()]
+    unknown = set(loaders) - set(LOADERS)
+    if unknown:
+        parser.error(f"unknown loaders: {', '.join(sorted(unknown))}")
+    os.makedirs(args.data_dir, exist_ok=True)
+    backend = "mongod" if args.mongo_url else "memory"
+
+    print(f"🚀 Ingestion benchmark ({backend} backend, malformed rate {args.malformed_rate:g})")
+    results = []
+    for rows in parse_sizes(args.sizes):
+        for loader in loaders:
+            source_path = ensure_source_file(args.data_dir, loader, rows, args.malformed_rate, args.seed)
+            print(f"⏱️ {loader} @ {rows:,} rows...")
+            try:
+                result = run_child(loader, source_path, args.mongo_url)
+            except RuntimeError as e:
+                print(f"❌ {e}")
+                result = {"loader": loader, "error": str(e)[-500:]}
+                results.append(dict(result, input_rows=rows))
+                continue
+            result["input_rows"] = rows
+            result["input_mb"] = round(os.path.getsize(source_path) / 1024 / 1024, 1)
+            results.append(result)
+            print(f"   ✅ {result['rows']:,} rows in {result['seconds']:.1f}s = {result['rows_per_sec']:,.0f} rows/sec, "
+                  f"peak RSS {result['peak_rss_mb']:,.0f} MB (+{result['peak_rss_workers_mb']:,.0f} MB workers), "
+                  f"loop stall max {result['stall_max_ms']:,.0f} ms / p99 {result['stall_p99_ms']:,.0f} ms "
+                  f"[{result['status']}]")
+            for phase, measured in result.get("phases", {}).items():
+                if measured["status"] == "skipped":
+                    print(f"   ⏭️ {phase} skipped ({measured['reason']})")
+                else:
+                    print(f"   ✅ {phase} in {measured['seconds']:.1f}s, loop stall max {measured['stall_max_ms']:,.0f} ms")
+
+    measured = [result for result in results if "error" not in result]
+    regressions = []
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("backend") != backend:
+            print(f"⚠️ Baseline was measured on the {baseline.get('backend')} backend, this run on {backend}")
+        regressions = compare_with_baseline(measured, baseline, args.tolerance)
+
+    report = {
+        "generated_at": datetime.now().isoformat(timespec="seconds"),
+        "backend": backend,
+        "python": sys.version.split()[0],
+        "cpu_count": os.cpu_count(),
+        "malformed_rate": args.malformed_rate,
+        "seed": args.seed,
+        "results": results,
+    }
+    # Comparing against a baseline never overwrites it
+    output = args.output
+    if args.compare and os.path.abspath(output) == os.path.abspath(args.compare):
+        output = os.path.splitext(output)[0] + "_latest.json"
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"💾 Results written to {output}")
+
+    if regressions:
+        print(f"❌ {len(regressions)} regression(s) against {args.compare}:")
+        for regression in regressions:
+            print(f"   - {regression}")
+        sys.exit(1)
+    if len(measured) < len(results):
+        sys.exit(1)
+    if args.compare:
+        print(f"✅ No regressions against {args.compare} (tolerance {args.tolerance:.0%})")
+
+if __name__ == "__main__":
+    main()
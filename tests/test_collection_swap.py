@@ -0,0 +1,98 @@
+"""Blue/green full reloads: staging swaps in by rename, a rollback brings the previous generation back"""
+import asyncio
+
+import pytest
+
+import server
+from ingestion_benchmark import MemoryDatabase
+
+
+@pytest.fixture
+def db(monkeypatch):
+    database = MemoryDatabase()
+    monkeypatch.setattr(server, "db", database)
+    return database
+
+
+def ids(database, name: str) -> set:
+    return set(database[name].ids) if name in database.collections else set()
+
+
+async def load_generation(database, rows: range):
+    staging = await server.begin_staging_collection("vendite_data")
+    await staging.insert_many([{"_id": i} for i in rows])
+    await server.swap_in_staging_collection("vendite_data")
+
+
+def test_swap_keeps_the_old_generation_as_previous(db):
+    async def scenario():
+        await load_generation(db, range(10))
+        await load_generation(db, range(100, 120))
+        return await server.current_data_version()
+
+    assert asyncio.run(scenario()) == 2
+    assert ids(db, "vendite_data") == set(range(100, 120))
+    assert ids(db, "vendite_data_previous") == set(range(10))
+    assert "vendite_data_staging" not in db.collections
+    assert db["vendite_data"].indexes  # built on staging, carried over by the rename
+
+
+def test_rollback_swaps_live_and_previous(db):
+    async def scenario():
+        await load_generation(db, range(10))
+        await load_generation(db, range(100, 120))
+        assert await server.rollback_collection("vendite_data")
+        return await server.current_data_version()
+
+    assert asyncio.run(scenario()) == 3
+    assert ids(db, "vendite_data") == set(range(10))
+    # The rolled-back generation can be rolled forward again
+    assert ids(db, "vendite_data_previous") == set(range(100, 120))
+    assert "vendite_data_rollback" not in db.collections
+
+    asyncio.run(server.rollback_collection("vendite_data"))
+    assert ids(db, "vendite_data") == set(range(100, 120))
+    assert ids(db, "vendite_data_previous") == set(range(10))
+
+
+def test_rollback_without_a_previous_generation_does_nothing(db):
+    async def scenario():
+        await load_generation(db, range(10))
+        return await server.rollback_collection("vendite_data"), await server.current_data_version()
+
+    assert asyncio.run(scenario()) == (False, 1)
+    assert ids(db, "vendite_data") == set(range(10))
+
+
+def test_abandoned_staging_keeps_the_live_generation(db):
+    fallback_calls = []
+
+    async def create_fallback():
+        fallback_calls.append(True)
+
+    async def scenario():
+        await load_generation(db, range(10))
+        staging = await server.begin_staging_collection("vendite_data")
+        await staging.insert_many([{"_id": i} for i in range(500, 505)])
+        await server.abandon_staging_collection("vendite_data", create_fallback)
+        return await server.current_data_version()
+
+    assert asyncio.run(scenario()) == 1
+    assert ids(db, "vendite_data") == set(range(10))
+    assert "vendite_data_staging" not in db.collections
+    assert fallback_calls == []
+
+
+def test_abandoned_first_load_seeds_the_fallback(db):
+    async def create_fallback():
+        await db["vendite_data"].insert_many([{"_id": "demo"}])
+
+    async def scenario():
+        staging = await server.begin_staging_collection("vendite_data")
+        await staging.insert_many([{"_id": 1}])
+        await server.abandon_staging_collection("vendite_data", create_fallback)
+        return await server.current_data_version()
+
+    assert asyncio.run(scenario()) == 1
+    assert ids(db, "vendite_data") == {"demo"}
+    assert "vendite_data_staging" not in db.collections
@@ -0,0 +1,111 @@
+"""FIELD_SCHEMAS converters: records are typed once at ingest, reads hand the values back as stored"""
+from datetime import datetime
+
+import pytest
+
+import server
+
+
+def converter(kind: str):
+    return server.FIELD_CONVERTER_FACTORIES[kind]()
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("1.234,56", 1234.56),
+    ("12,5", 12.5),
+    (" 7.25 ", 7.25),
+    (3, 3.0),
+    (2.5, 2.5),
+    ("", 0.0),
+    (None, 0.0),
+    ("n/d", 0.0),
+])
+def test_decimal(value, expected):
+    assert converter("decimal")(value) == expected
+
+
+@pytest.mark.parametrize("value, expected", [("12", 12), ("3,0", 3), (4.0, 4), (5, 5), ("", 0), (None, 0)])
+def test_int(value, expected):
+    result = converter("int")(value)
+    assert result == expected and result.__class__ is int
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("20200630", "20200630"),
+    ("2020-06-30", "20200630"),
+    ("2020-6-3 11:50", "20200603"),
+    ("2020/06/30", "20200630"),
+    (datetime(2021, 1, 5, 9, 30), "20210105"),
+    ("", ""),
+    (None, ""),
+    ("30/06/2020", "30/06/2020"),  # not year-first: kept as it came
+])
+def test_date(value, expected):
+    assert converter("date")(value) == expected
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("1", True), ("SI", True), ("si ", True), ("X", True), (1, True), (True, True),
+    ("0", False), ("NO", False), ("n", False), (0, False), (0.0, False),
+    ("", None), (None, None), ("FORSE", None),
+])
+def test_flag(value, expected):
+    assert converter("flag")(value) is expected
+
+
+@pytest.mark.parametrize("value, expected", [(" MARIA ", "MARIA"), (70010.0, "70010"), (12.5, "12.5"), (7, "7"), (None, "")])
+def test_text(value, expected):
+    assert converter("text")(value) == expected
+
+
+def test_projected_schema_keeps_only_its_fields():
+    convert = server.compile_schema("vendite", project=True)
+    typed = convert({"DATA_VENDITA": "2024-03-01", "TOT_IMPORTO": "1,50", "NEGOZIO": 3.0, "EXTRA": "x"})
+    assert set(typed) == set(server.FIELD_SCHEMAS["vendite"])
+    assert typed["DATA_VENDITA"] == "20240301"
+    assert typed["TOT_IMPORTO"] == 1.5
+    assert typed["NEGOZIO"] == "3"
+    assert typed["TOT_QNT"] == 0.0 and typed["CODICE_CLIENTE"] == ""
+
+
+def test_plain_schema_passes_other_fields_through():
+    typed = server.convert_fidelity_record({"bollini": "12", "custom": " kept "})
+    assert typed == {"bollini": 12, "custom": " kept "}
+
+
+def test_fidelity_user_data_reads_the_typed_document(monkeypatch):
+    document = server.prepare_fidelity_document({
+        "card_number": " 2020000012345 ",
+        "nome": " MARIA ",
+        "sesso": "f",
+        "email": " maria@example.com",
+        "cap": 70010.0,
+        "prog_spesa": "1.234,56",
+        "bollini": "250",
+        "numero_figli": "2",
+        "data_nas": "1980-04-02",
+        "dati_pers": "SI",
+        "dati_pubb": "0",
+        "profilazione": "",
+        "marketing": "1",
+        "lattosio": "SI",
+    })
+    assert document["_id"] == document["tessera_fisica"] == "2020000012345"
+    monkeypatch.setattr(server, "FIDELITY_DATA", {document["_id"]: document})
+
+    user = server.get_fidelity_user_data("2020000012345")
+    assert user["nome"] == "MARIA" and user["sesso"] == "F"
+    assert user["email"] == "maria@example.com" and user["cap"] == "70010"
+    assert user["progressivo_spesa"] == 1234.56
+    assert user["bollini"] == 250 and user["numero_figli"] == 2
+    assert user["data_nascita"] == "19800402"
+    assert user["consenso_dati_personali"] is True and user["consenso_dati_pubblicitari"] is False
+    assert user["consenso_profilazione"] is None and user["consenso_marketing"] is True
+    assert user["intolleranza_lattosio"] is True and user["intolleranza_glutine"] is False
+    assert user["stato_tessera"] == "01"
+    assert server.get_fidelity_user_data("missing") is None
+
+
+def test_cards_without_a_number_are_not_stored():
+    assert server.prepare_fidelity_document({"nome": "MARIA"}) is None
+    assert server.prepare_fidelity_document({"card_number": "  "}) is None
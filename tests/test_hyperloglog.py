@@ -0,0 +1,90 @@
+"""HyperLogLog sketches: accuracy, merging, storage and the ingest-time accumulator"""
+import random
+import zlib
+
+import numpy as np
+import pytest
+
+import server
+
+
+def values(count: int, seed: int) -> list:
+    rng = random.Random(seed)
+    return [f"C{rng.randrange(10 ** 12)}" for _ in range(count)]
+
+
+def sketch_of(items) -> server.HyperLogLog:
+    sketch = server.HyperLogLog()
+    sketch.add(list(items))
+    return sketch
+
+
+def test_hashes_are_stable_across_processes():
+    # Stored sketches are merged with ones built later, maybe by another worker
+    assert server.hll_hashes(["a"]).tolist() == [9266097309480679803]
+    assert server.hll_hashes([5]).tolist() == server.hll_hashes(["5"]).tolist()
+    # The batch's longest value must not change anyone else's hash
+    assert server.hll_hashes(["ab", "x" * 41])[0] == server.hll_hashes(["ab"])[0]
+
+
+@pytest.mark.parametrize("count", [0, 1, 10, 1000, 50000])
+def test_estimate_within_three_standard_errors(count):
+    items = values(count, seed=count)
+    exact = len(set(items))
+    estimate = sketch_of(items).count()
+    assert abs(estimate - exact) <= 3 * server.HLL_STANDARD_ERROR * exact
+
+
+def test_merge_is_the_sketch_of_the_union():
+    left, right = values(4000, seed=1), values(4000, seed=2)
+    shared = left[:1500]
+    merged = sketch_of(left).merge(sketch_of(right + shared))
+    assert np.array_equal(merged.registers, sketch_of(left + right).registers)
+
+
+@pytest.mark.parametrize("count", [0, 3, 800, 20000])
+def test_bytes_round_trip(count):
+    sketch = sketch_of(values(count, seed=3))
+    data = sketch.to_bytes()
+    # Few set registers are stored as pairs, the rest as compressed registers
+    sparse = np.count_nonzero(sketch.registers) <= server.HLL_SPARSE_MAX
+    assert data.startswith(server.HLL_SPARSE_MARKER) == sparse
+    assert np.array_equal(server.HyperLogLog.from_bytes(data).registers, sketch.registers)
+
+
+def test_dense_sketches_stored_before_the_sparse_form_still_load():
+    sketch = sketch_of(values(100, seed=4))
+    stored = zlib.compress(sketch.registers.tobytes(), 1)
+    assert np.array_equal(server.HyperLogLog.from_bytes(stored).registers, sketch.registers)
+
+
+def test_accumulator_groups_match_per_group_sketches():
+    rng = random.Random(5)
+    docs = [
+        {
+            "DATA_SCONTRINO": f"202501{rng.randrange(1, 4):02d}",
+            "DITTA": str(rng.randrange(1, 3)),
+            "CODICE_CLIENTE": rng.choice(["", None] + [f"C{n}" for n in range(2000)]),
+        }
+        for _ in range(6000)
+    ]
+    accumulator = server.SketchAccumulator("scontrini_data")
+    for start in range(0, len(docs), 1000):
+        accumulator.add(docs[start:start + 1000])
+    accumulator._compact()
+
+    name = "scontrini_sketch_daily"
+    ids = [{"day": day, "store": store} for day, store in accumulator.group_numbers[name]]
+    operations = accumulator._sketch_updates(name, ids, stored={})
+
+    expected = {}
+    for doc in docs:
+        key = (doc["DATA_SCONTRINO"], doc["DITTA"])
+        expected.setdefault(key, set())
+        if doc["CODICE_CLIENTE"]:
+            expected[key].add(doc["CODICE_CLIENTE"])
+    assert len(operations) == len(expected)
+    for operation in operations:
+        key = (operation._filter["_id"]["day"], operation._filter["_id"]["store"])
+        stored = server.HyperLogLog.from_bytes(operation._doc["$set"]["customers"])
+        assert np.array_equal(stored.registers, sketch_of(expected[key]).registers)
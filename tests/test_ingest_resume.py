@@ -0,0 +1,121 @@
+"""Resuming full reloads: failed batches are never checkpointed, vendite restarts at a shard offset"""
+import asyncio
+import gzip
+import json
+import random
+
+import pytest
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+import server
+from ingestion_benchmark import MemoryDatabase
+
+
+class InsertResult:
+    def __init__(self, ids):
+        self.inserted_ids = ids
+
+
+class FlakyCollection:
+    """Stores docs by _id; a batch holding fail_id is cut short by a connection error"""
+
+    def __init__(self, fail_id: int, failures: int):
+        self.docs = {}
+        self.fail_id = fail_id
+        self.failures = failures
+
+    async def insert_many(self, docs, **kwargs):
+        inserted, errors = [], []
+        for index, doc in enumerate(docs):
+            if doc["_id"] == self.fail_id and self.failures:
+                self.failures -= 1
+                raise AutoReconnect("connection reset")
+            if doc["_id"] in self.docs:
+                errors.append({"index": index, "code": 11000})
+                continue
+            self.docs[doc["_id"]] = doc
+            inserted.append(doc["_id"])
+        if errors:
+            raise BulkWriteError({"nInserted": len(inserted), "writeErrors": errors})
+        return InsertResult(inserted)
+
+
+class RecordingCheckpoint:
+    def __init__(self):
+        self.positions = []
+
+    async def save(self, position: int, batches: int, rows: int, failed: int = 0):
+        self.positions.append(position)
+
+
+def pipeline(collection, rows: int, **kwargs):
+    coro = server.run_ingestion_pipeline(
+        ({"_id": i} for i in range(rows)), lambda record: record, collection, "test", writers=1,
+        sizer=server.AdaptiveBatchSizer(initial=100, minimum=100, maximum=100), **kwargs
+    )
+    return asyncio.run(asyncio.wait_for(coro, timeout=30))
+
+
+def test_a_batch_that_keeps_failing_stops_the_load_before_it(monkeypatch):
+    monkeypatch.setattr(server, "INGEST_BATCH_ATTEMPTS", 2)
+    checkpoint = RecordingCheckpoint()
+    with pytest.raises(AutoReconnect):
+        pipeline(FlakyCollection(fail_id=250, failures=10), 1000, checkpoint=checkpoint)
+    # Rows 200..299 never all landed, so a resume must start at 200 at the latest
+    assert checkpoint.positions and max(checkpoint.positions) <= 200
+
+
+def test_a_retried_batch_counts_what_the_failed_attempt_stored():
+    collection = FlakyCollection(fail_id=250, failures=1)
+    folded = []
+
+    async def on_written(docs):
+        folded.extend(doc["_id"] for doc in docs)
+
+    stats = pipeline(collection, 1000, on_written=on_written)
+    assert sorted(collection.docs) == list(range(1000))
+    assert stats["rows_written"] == 1000 and stats["rows_failed"] == 0
+    assert sorted(folded) == list(range(1000))
+
+
+@pytest.mark.parametrize("compressed", [False, True])
+def test_shards_resume_at_their_offset(tmp_path, compressed):
+    rng = random.Random(4)
+    # Values holding "}, {" make some cuts land inside a string
+    records = [{"i": i, "text": "x}, {y" * rng.randrange(3) + "a" * rng.randrange(60)} for i in range(2000)]
+    text = "  [\n " + ",\n ".join(json.dumps(record) for record in records) + "\n]\n"
+    path = tmp_path / ("vendite.json.gz" if compressed else "vendite.json")
+    with (gzip.open(path, "wt") if compressed else open(path, "w")) as f:
+        f.write(text)
+
+    shards = list(server.iter_json_shards(str(path), workers=1, shard_size=4096))
+    assert len(shards) > 5
+    assert [record for _, shard in shards for record in shard] == records
+    first = 0
+    for offset, shard in shards:
+        resumed = server.iter_json_shards(str(path), workers=1, shard_size=4096, start_offset=offset)
+        assert [record for _, rest in resumed for record in rest] == records[first:]
+        first += len(shard)
+
+
+def test_checkpoint_keeps_the_last_seek_point_before_its_position(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "db", MemoryDatabase())
+    source = tmp_path / "vendite.json"
+    source.write_text("[]")
+
+    async def scenario():
+        checkpoint = server.IngestCheckpoint("vendite_data", str(source))
+        await checkpoint.start()
+        for position, offset in ((0, 1), (100, 5000), (200, 9000)):
+            checkpoint.mark_seek_point(position, offset)
+        await checkpoint.save(150, 2, 150)
+        assert (checkpoint.seek_position, checkpoint.seek_offset) == (100, 5000)
+        await checkpoint.save(180, 3, 180)
+        assert (checkpoint.seek_position, checkpoint.seek_offset) == (100, 5000)
+
+        resumed = server.IngestCheckpoint("vendite_data", str(source))
+        assert await resumed.load()
+        return resumed
+
+    resumed = asyncio.run(scenario())
+    assert (resumed.position, resumed.seek_position, resumed.seek_offset) == (180, 100, 5000)
@@ -0,0 +1,111 @@
+"""run_ingestion_pipeline: every row lands once and the checkpoint only moves past stored batches"""
+import asyncio
+import random
+
+import pytest
+
+import server
+
+
+class InsertResult:
+    def __init__(self, ids):
+        self.inserted_ids = ids
+
+
+class SlowCollection:
+    """insert_many with a random delay per batch, so concurrent writers finish out of order"""
+
+    def __init__(self, seed: int = 3):
+        self.docs = {}
+        self.rng = random.Random(seed)
+
+    async def insert_many(self, docs, **kwargs):
+        await asyncio.sleep(self.rng.random() / 200)
+        for doc in docs:
+            assert doc["_id"] not in self.docs
+            self.docs[doc["_id"]] = doc
+        return InsertResult([doc["_id"] for doc in docs])
+
+
+class RecordingCheckpoint:
+    """Checks, at every save, that all the records before the saved position are stored"""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.positions = []
+
+    async def save(self, position: int, batches: int, rows: int, failed: int = 0):
+        assert all(index in self.collection.docs for index in range(position))
+        self.positions.append(position)
+
+
+def run(coro):
+    # A hang is the failure mode these tests guard against
+    return asyncio.run(asyncio.wait_for(coro, timeout=30))
+
+
+def pipeline(records, collection, **kwargs):
+    return server.run_ingestion_pipeline(
+        records, lambda record: record, collection, "test",
+        sizer=server.AdaptiveBatchSizer(initial=50, minimum=50, maximum=50), **kwargs
+    )
+
+
+def test_every_record_is_written_once():
+    collection = SlowCollection()
+    stats = run(pipeline(({"_id": i} for i in range(2000)), collection, writers=4))
+    assert sorted(collection.docs) == list(range(2000))
+    assert stats["rows_read"] == stats["rows_written"] == 2000
+    assert stats["batches"] == 40
+    assert stats["position"] == 2000
+
+
+def test_checkpoint_follows_the_contiguous_watermark():
+    collection = SlowCollection()
+    checkpoint = RecordingCheckpoint(collection)
+    run(pipeline(({"_id": i} for i in range(2000)), collection, writers=4, checkpoint=checkpoint))
+    assert checkpoint.positions == sorted(checkpoint.positions)
+    assert checkpoint.positions[-1] == 2000
+
+
+def test_resumed_positions_start_from_the_checkpoint():
+    collection = SlowCollection()
+    checkpoint = RecordingCheckpoint(collection)
+    collection.docs.update({i: {"_id": i} for i in range(500)})
+    stats = run(pipeline(({"_id": i} for i in range(500, 1000)), collection, writers=2,
+                         start_position=500, checkpoint=checkpoint))
+    assert stats["position"] == checkpoint.positions[-1] == 1000
+
+
+def test_on_written_sees_only_stored_rows():
+    collection = SlowCollection()
+    folded = []
+
+    async def on_written(docs):
+        assert all(doc["_id"] in collection.docs for doc in docs)
+        folded.extend(doc["_id"] for doc in docs)
+
+    run(pipeline(({"_id": i} for i in range(1000)), collection, writers=3, on_written=on_written))
+    assert sorted(folded) == list(range(1000))
+
+
+@pytest.mark.parametrize("failing", ["on_written", "checkpoint"])
+def test_a_dead_writer_stops_the_load_and_raises(failing):
+    collection = SlowCollection()
+    calls = []
+
+    async def fail_on_third(*args):
+        calls.append(args)
+        if len(calls) == 3:
+            raise RuntimeError("flush failed")
+
+    checkpoint = RecordingCheckpoint(collection)
+    if failing == "checkpoint":
+        checkpoint.save = fail_on_third
+    on_written = fail_on_third if failing == "on_written" else None
+
+    # Far more batches than the queue holds: without the stop the producer would block for good
+    with pytest.raises(RuntimeError, match="flush failed"):
+        run(pipeline(({"_id": i} for i in range(100000)), collection, writers=2,
+                     checkpoint=checkpoint, on_written=on_written))
+    assert len(collection.docs) < 100000
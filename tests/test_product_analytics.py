@@ -0,0 +1,154 @@
+"""Product and department analytics match the full-sort version they replaced; customers come from a sketch"""
+import random
+from collections import defaultdict
+
+import pytest
+
+import server
+
+
+def sales(count: int = 6000) -> list:
+    rng = random.Random(21)
+    rows = []
+    for _ in range(count):
+        rows.append({
+            # Whole-euro amounts so several products tie on revenue
+            "BARCODE": "" if rng.random() < 0.03 else f"80{rng.randrange(300):05d}",
+            "CODICE_CLIENTE": f"C{rng.randrange(1500)}",
+            "REPARTO": rng.choice(["01", "02", "03", "07", "000", "42"]),
+            "TOT_IMPORTO": rng.randrange(1, 6),
+            "TOT_QNT": rng.choice([1, 2, 0.5]),
+            "MESE": rng.choice(["202401", "202402", "202403"]),
+        })
+    return rows
+
+
+def legacy_product_analytics(rows: list, limit: int) -> list:
+    """The grouping before the streaming rewrite: row lists per product, then a full sort"""
+    metrics_of = defaultdict(lambda: {"total_quantity": 0, "total_revenue": 0, "customers": set(), "reparto": "", "transactions": []})
+    for sale in rows:
+        bc = sale.get("BARCODE")
+        if bc:
+            metrics = metrics_of[bc]
+            metrics["total_quantity"] += float(sale.get("TOT_QNT", 0))
+            metrics["total_revenue"] += float(sale.get("TOT_IMPORTO", 0))
+            metrics["customers"].add(sale.get("CODICE_CLIENTE", ""))
+            metrics["reparto"] = sale.get("REPARTO", "000")
+            metrics["transactions"].append(sale)
+    products = []
+    for barcode, metrics in metrics_of.items():
+        monthly_sales = defaultdict(float)
+        for tx in metrics["transactions"]:
+            monthly_sales[tx.get("MESE", "")] += float(tx.get("TOT_IMPORTO", 0))
+        products.append({
+            "barcode": barcode,
+            "reparto": metrics["reparto"],
+            "total_quantity": metrics["total_quantity"],
+            "total_revenue": metrics["total_revenue"],
+            "unique_customers": len(metrics["customers"]),
+            "avg_price": metrics["total_revenue"] / metrics["total_quantity"] if metrics["total_quantity"] > 0 else 0,
+            "monthly_trends": [{"month": k, "sales": v} for k, v in sorted(monthly_sales.items())],
+        })
+    products.sort(key=lambda x: x["total_revenue"], reverse=True)
+    for i, product in enumerate(products[:limit]):
+        product["popularity_rank"] = i + 1
+    return products[:limit]
+
+
+def legacy_department_analytics(rows: list) -> list:
+    metrics_of = defaultdict(lambda: {"total_revenue": 0, "total_quantity": 0, "products": set(), "customers": set(), "transactions": []})
+    for sale in rows:
+        metrics = metrics_of[sale.get("REPARTO", "000")]
+        metrics["total_revenue"] += float(sale.get("TOT_IMPORTO", 0))
+        metrics["total_quantity"] += float(sale.get("TOT_QNT", 0))
+        metrics["customers"].add(sale.get("CODICE_CLIENTE", ""))
+        metrics["transactions"].append(sale)
+        if sale.get("BARCODE"):
+            metrics["products"].add(sale["BARCODE"])
+    departments = []
+    for code, metrics in metrics_of.items():
+        product_sales = defaultdict(float)
+        for tx in metrics["transactions"]:
+            if tx.get("BARCODE"):
+                product_sales[tx["BARCODE"]] += float(tx.get("TOT_IMPORTO", 0))
+        departments.append({
+            "reparto_code": code,
+            "total_revenue": metrics["total_revenue"],
+            "total_quantity": metrics["total_quantity"],
+            "unique_products": len(metrics["products"]),
+            "unique_customers": len(metrics["customers"]),
+            "avg_transaction": metrics["total_revenue"] / len(metrics["transactions"]),
+            "top_products": [{"barcode": k, "revenue": v} for k, v in sorted(product_sales.items(), key=lambda x: x[1], reverse=True)[:5]],
+        })
+    return sorted(departments, key=lambda x: x["total_revenue"], reverse=True)
+
+
+@pytest.fixture
+def rows(monkeypatch):
+    data = sales()
+    monkeypatch.setattr(server, "VENDITE_DATA", data)
+    monkeypatch.setattr(server, "VENDITE_INDEX", None)
+    return data
+
+
+def split_customers(results: list) -> tuple:
+    estimates = [result.pop("unique_customers") for result in results]
+    return results, estimates
+
+
+@pytest.mark.parametrize("limit", [100, 7, 1000, 0])
+def test_top_products_match_the_full_sort(rows, limit):
+    products, estimated = split_customers(server.get_product_analytics(limit=limit))
+    expected, exact = split_customers(legacy_product_analytics(rows, limit))
+    assert products == expected
+    for estimate, count in zip(estimated, exact):
+        assert abs(estimate - count) <= max(2, 0.25 * count)
+
+
+def test_single_product_matches_the_full_sort(rows):
+    barcode = rows[0]["BARCODE"] or rows[1]["BARCODE"]
+    products = server.get_product_analytics(barcode=barcode)
+    expected = legacy_product_analytics([row for row in rows if row["BARCODE"] == barcode], 100)
+    assert [product["barcode"] for product in products] == [barcode]
+    assert {**products[0], "unique_customers": 0} == {**expected[0], "unique_customers": 0}
+
+
+def test_departments_match_the_full_sort(rows):
+    departments = server.get_department_analytics()
+    names = {department["reparto_code"]: department.pop("reparto_name") for department in departments}
+    assert names["01"] == "Alimentari" and names["000"] == "Generico" and names["42"] == "Reparto 42"
+    departments, estimated = split_customers(departments)
+    expected, exact = split_customers(legacy_department_analytics(rows))
+    assert departments == expected
+    for estimate, count in zip(estimated, exact):
+        assert abs(estimate - count) <= 0.05 * count
+
+
+def test_keyed_sketches_count_each_key_apart(monkeypatch):
+    monkeypatch.setattr(server, "KEYED_HLL_CHUNK", 1000)  # fold several times while adding
+    sketch = server.KeyedHyperLogLog()
+    expected = {key: set() for key in range(6)}
+    rng = random.Random(5)
+    for _ in range(20000):
+        key = rng.randrange(6)
+        value = f"C{rng.randrange(40 ** (key + 1) // 40 + 1)}"
+        sketch.add(key, value)
+        expected[key].add(value)
+
+    assert sketch.registers.shape[1] == 1 << server.KEYED_HLL_PRECISION
+    for key, values in expected.items():
+        assert abs(sketch.count(key) - len(values)) <= max(1, 0.2 * len(values))
+    assert sketch.count(99) == 0
+
+
+def test_keyed_sketch_rows_equal_single_sketches():
+    rng = random.Random(8)
+    values = [f"C{rng.randrange(10 ** 9)}" for _ in range(5000)]
+    keyed = server.KeyedHyperLogLog(server.HLL_PRECISION)
+    for i, value in enumerate(values):
+        keyed.add(i % 2, value)
+    for key in (0, 1):
+        single = server.HyperLogLog()
+        single.add(values[key::2])
+        assert keyed.count(key) == single.count()
+        assert (keyed.registers[key] == single.registers).all()
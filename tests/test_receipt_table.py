@@ -0,0 +1,143 @@
+"""ReceiptTable against the per-receipt loops it replaced"""
+import random
+from collections import defaultdict
+
+import numpy as np
+import pytest
+
+import server
+
+
+def legacy_dashboard_analytics(records):
+    """get_dashboard_analytics() as it was, one Python pass over the receipt dicts per figure"""
+    total_revenue = sum(float(record.get('IMPORTO_SCONTRINO', 0)) for record in records)
+    total_transactions = len(records)
+    total_bollini = sum(float(record.get('N_BOLLINI', 0)) for record in records)
+    unique_customers = len(set(record.get('CODICE_CLIENTE', '') for record in records))
+
+    revenue_by_store = defaultdict(float)
+    transactions_by_store = defaultdict(int)
+    for record in records:
+        store_id = record.get('DITTA', '')
+        revenue_by_store[store_id] += float(record.get('IMPORTO_SCONTRINO', 0))
+        transactions_by_store[store_id] += 1
+
+    daily_revenue = defaultdict(float)
+    daily_transactions = defaultdict(int)
+    for record in records:
+        date_str = record.get('DATA_SCONTRINO', '')
+        if len(date_str) == 8:
+            daily_revenue[date_str] += float(record.get('IMPORTO_SCONTRINO', 0))
+            daily_transactions[date_str] += 1
+
+    customer_spending = defaultdict(float)
+    customer_transactions = defaultdict(int)
+    for record in records:
+        customer_id = record.get('CODICE_CLIENTE', '')
+        customer_spending[customer_id] += float(record.get('IMPORTO_SCONTRINO', 0))
+        customer_transactions[customer_id] += 1
+    top_customers = sorted(customer_spending.items(), key=lambda x: x[1], reverse=True)[:10]
+
+    payment_methods = defaultdict(int)
+    for record in records:
+        payment = record.get('TIPO_PAGAM1', '')
+        if payment:
+            payment_methods[payment] += 1
+
+    hourly_distribution = defaultdict(int)
+    for record in records:
+        hour = record.get('ORA_SCONTRINO', 0)
+        if isinstance(hour, int) and hour > 0:
+            hour_formatted = hour // 100
+            if 0 <= hour_formatted <= 23:
+                hourly_distribution[hour_formatted] += 1
+
+    return {
+        "summary": {
+            "total_revenue": round(total_revenue, 2),
+            "total_transactions": total_transactions,
+            "total_bollini": int(total_bollini),
+            "unique_customers": unique_customers,
+            "avg_transaction": round(total_revenue / total_transactions if total_transactions > 0 else 0, 2),
+            "avg_bollini_per_transaction": round(total_bollini / total_transactions if total_transactions > 0 else 0, 2)
+        },
+        "revenue_by_store": [
+            {"store_id": store_id, "revenue": round(revenue, 2), "transactions": transactions_by_store[store_id]}
+            for store_id, revenue in sorted(revenue_by_store.items(), key=lambda x: x[1], reverse=True)
+        ],
+        "daily_trend": [
+            {"date": date, "revenue": round(revenue, 2), "transactions": daily_transactions[date]}
+            for date, revenue in sorted(daily_revenue.items())
+        ][-30:],
+        "top_customers": [
+            {"customer_id": customer_id, "total_spent": round(spent, 2), "transactions": customer_transactions[customer_id]}
+            for customer_id, spent in top_customers
+        ],
+        "payment_methods": [
+            {"method": method, "count": count}
+            for method, count in sorted(payment_methods.items(), key=lambda x: x[1], reverse=True)
+        ],
+        "hourly_distribution": [
+            {"hour": hour, "transactions": count}
+            for hour, count in sorted(hourly_distribution.items())
+        ]
+    }
+
+
+def make_receipts(count: int, seed: int = 7) -> list:
+    """Receipts with the export's oddities: missing fields, blank customers, short dates, odd times"""
+    rng = random.Random(seed)
+    receipts = []
+    for _ in range(count):
+        receipt = {
+            # Quarter amounts add up exactly in binary, so the sums can't differ by summation order
+            "IMPORTO_SCONTRINO": rng.randrange(1, 800) / 4,
+            "N_BOLLINI": rng.randrange(0, 12),
+            "CODICE_CLIENTE": rng.choice(["", "C1", "C2"] + [f"C{n}" for n in range(3, 400)]),
+            "DITTA": str(rng.randrange(1, 6)),
+            "DATA_SCONTRINO": rng.choice([f"2025{rng.randrange(1, 13):02d}{rng.randrange(1, 29):02d}", "2025011", ""]),
+            "ORA_SCONTRINO": rng.choice([0, -5, 930, 1215, 2359, 2500, "1030"]),
+        }
+        if rng.random() < 0.3:
+            receipt["TIPO_PAGAM1"] = rng.choice(["", "CONTANTI", "BANCOMAT", "CARTA"])
+        if rng.random() < 0.05:
+            del receipt["DITTA"]
+        receipts.append(receipt)
+    return receipts
+
+
+@pytest.fixture
+def receipts(monkeypatch):
+    records = make_receipts(3000)
+    monkeypatch.setattr(server, "SCONTRINI_DATA", records)
+    return records
+
+
+def test_dashboard_analytics_matches_the_receipt_loops(receipts):
+    assert server.get_dashboard_analytics() == legacy_dashboard_analytics(receipts)
+
+
+def test_rows_rebuild_the_original_receipts(receipts):
+    table = server.ReceiptTable.from_records(receipts)
+    assert len(table) == len(receipts)
+    assert table.rows(np.arange(len(receipts))) == receipts
+
+
+def test_group_by_merges_missing_and_blank_keys(receipts):
+    table = server.ReceiptTable.from_records(receipts)
+    groups = table.group_by('DITTA', sums=('amount',))
+    expected = defaultdict(lambda: [0, 0.0])
+    for receipt in receipts:
+        expected[receipt.get('DITTA', '')][0] += 1
+        expected[receipt.get('DITTA', '')][1] += receipt['IMPORTO_SCONTRINO']
+    assert {store: [group['count'], group['amount']] for store, group in groups.items()} == dict(expected)
+
+
+def test_unparseable_amounts_are_flagged_not_summed():
+    table = server.ReceiptTable.from_records([
+        {"IMPORTO_SCONTRINO": "12.5", "N_BOLLINI": "1"},
+        {"IMPORTO_SCONTRINO": "12,5", "N_BOLLINI": "1"},
+        {"N_BOLLINI": None},
+    ])
+    assert table.valid.tolist() == [True, False, False]
+    assert table.sum('amount') == 12.5
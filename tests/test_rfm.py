@@ -0,0 +1,67 @@
+"""Quintile bands against the linear scan calculate_rfm_segmentation() used to score with"""
+import random
+
+import numpy as np
+import pytest
+
+import server
+
+
+def legacy_quintile_score(value, sorted_values, reverse=False):
+    """get_quintile_score() from the original calculate_rfm_segmentation()"""
+    n = len(sorted_values)
+    if n == 0:
+        return 3
+
+    position = 0
+    for i, v in enumerate(sorted_values):
+        if value <= v:
+            position = i
+            break
+    else:
+        position = n - 1
+
+    quintile = min(5, max(1, int((position / n) * 5) + 1))
+    if reverse:
+        quintile = 6 - quintile
+    return quintile
+
+
+def populations():
+    rng = random.Random(11)
+    yield [5]
+    yield [3, 3, 3, 3]
+    yield [1, 2, 3, 4, 5, 6, 7]
+    yield [rng.randrange(0, 400) for _ in range(1000)]            # recency-like, heavy ties
+    yield [rng.randrange(1, 30) for _ in range(257)]              # frequency-like
+    yield [round(rng.uniform(0, 5000), 2) for _ in range(999)]    # monetary-like
+
+
+@pytest.mark.parametrize("values", list(populations()))
+def test_ascending_band_scores_like_the_scan(values):
+    band = server.rfm_band(np.array(values))
+    scores = server.rfm_band_scores(np.array(values), band, invert=True)
+    expected = [legacy_quintile_score(value, sorted(values), reverse=True) for value in values]
+    assert scores.tolist() == expected
+
+
+@pytest.mark.parametrize("values", list(populations()))
+def test_descending_band_scores_like_the_scan(values):
+    band = server.rfm_band(np.array(values), descending=True)
+    scores = server.rfm_band_scores(np.array(values), band)
+    expected = [legacy_quintile_score(value, sorted(values, reverse=True)) for value in values]
+    assert scores.tolist() == expected
+
+
+def test_stored_bands_score_new_values():
+    values = np.array([10, 20, 30, 40, 50, 60, 70, 80, 90, 100])
+    band = server.rfm_band(values)
+    # Values never seen when the band was cut land in the bucket the scan would have put them in
+    for value in (0, 15, 55, 1000):
+        scanned = legacy_quintile_score(value, sorted(values.tolist()))
+        assert server.rfm_band_scores(np.array([value]), band).tolist() == [scanned]
+
+
+def test_empty_population_scores_three():
+    band = server.rfm_band(np.array([]))
+    assert server.rfm_band_scores(np.array([1.0, 2.0]), band).tolist() == [3, 3]
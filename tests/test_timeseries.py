@@ -0,0 +1,71 @@
+"""Time-series bucketing of the daily / hourly rollups"""
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+
+import server
+
+
+def test_day_buckets_cover_every_day_in_order():
+    buckets = server.timeseries_buckets(datetime(2024, 2, 27), datetime(2024, 3, 2), "day")
+    assert list(buckets) == ["2024-02-27", "2024-02-28", "2024-02-29", "2024-03-01", "2024-03-02"]
+    assert all(first == datetime.strptime(label, "%Y-%m-%d") for label, first in buckets.items())
+
+
+def test_hour_buckets():
+    buckets = server.timeseries_buckets(datetime(2025, 1, 1), datetime(2025, 1, 2), "hour")
+    assert len(buckets) == 48
+    assert list(buckets)[:2] == ["2025-01-01 00:00", "2025-01-01 01:00"]
+    assert list(buckets)[-1] == "2025-01-02 23:00"
+    assert buckets["2025-01-02 05:00"] == datetime(2025, 1, 2)
+
+
+def test_week_buckets_follow_iso_weeks_across_the_year_end():
+    buckets = server.timeseries_buckets(datetime(2024, 12, 25), datetime(2025, 1, 7), "week")
+    assert buckets == {
+        "2024-W52": datetime(2024, 12, 23),
+        "2025-W01": datetime(2024, 12, 30),
+        "2025-W02": datetime(2025, 1, 6),
+    }
+
+
+def test_month_buckets_start_on_the_first():
+    buckets = server.timeseries_buckets(datetime(2024, 11, 15), datetime(2025, 2, 3), "month")
+    assert buckets == {
+        "2024-11": datetime(2024, 11, 1),
+        "2024-12": datetime(2024, 12, 1),
+        "2025-01": datetime(2025, 1, 1),
+        "2025-02": datetime(2025, 2, 1),
+    }
+
+
+@pytest.mark.parametrize("granularity", server.TIMESERIES_GRANULARITIES)
+def test_every_day_falls_in_one_of_the_buckets(granularity):
+    start, end = datetime(2025, 3, 1), datetime(2025, 3, 1) + timedelta(days=40)
+    buckets = server.timeseries_buckets(start, end, granularity)
+    day = start
+    while day <= end:
+        label, first = server.timeseries_bucket(day, 0, granularity)
+        assert buckets[label] == first <= day
+        day += timedelta(days=1)
+
+
+def test_previous_ranges():
+    start, end = datetime(2025, 3, 1), datetime(2025, 3, 10)
+    assert server.timeseries_previous_range(start, end, "prev_period") == (datetime(2025, 2, 19), datetime(2025, 2, 28))
+    assert server.timeseries_previous_range(start, end, "prev_year") == (datetime(2024, 3, 1), datetime(2024, 3, 10))
+    assert server.timeseries_previous_range(datetime(2024, 2, 29), datetime(2024, 3, 1), "prev_year") == (
+        datetime(2023, 2, 28), datetime(2023, 3, 1)
+    )
+
+
+@pytest.mark.parametrize("filters", [
+    {"store": "1", "reparto": "01"},  # store is a receipt DITTA, the reparto series has no DITTA
+    {"negozio": "1"},                 # negozio only exists on the sale lines read with reparto
+])
+def test_store_filters_must_match_the_rollup_they_read(filters):
+    with pytest.raises(HTTPException) as raised:
+        asyncio.run(server.get_timeseries(admin=None, **filters))
+    assert raised.value.status_code == 400
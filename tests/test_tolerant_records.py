@@ -0,0 +1,88 @@
+"""iter_tolerant_records: plain JSON parses like json.load, the export's breakages are repaired"""
+import gzip
+import json
+import random
+
+import pytest
+
+import server
+
+
+def cards(count: int) -> list:
+    rng = random.Random(9)
+    return [
+        {
+            "card_number": f"20200{i:08d}",
+            "nome": rng.choice(["MARIA", "GIUSEPPE", "NICOLÒ", "ANNA \"NINA\""]),
+            "indirizzo": rng.choice(["VIA ROMA N.1", "C.SO ITALIA, 5", "P.ZZA {DUOMO}", "VIA A\\B"]),
+            "prog_spesa": f"{rng.randrange(5000)},{rng.randrange(100):02d}",
+            "figli": [],
+            "extra": {"k": rng.randrange(3)},
+        }
+        for i in range(count)
+    ]
+
+
+def records_of(path, **kwargs) -> list:
+    return [record for _, record in server.iter_tolerant_records(str(path), **kwargs)]
+
+
+@pytest.mark.parametrize("chunk_size", [7, 64, server.JSON_STREAM_CHUNK_SIZE])
+def test_clean_array_parses_like_json(tmp_path, chunk_size):
+    path = tmp_path / "fidelity_complete.json"
+    path.write_text(json.dumps(cards(300), indent="\t", ensure_ascii=False), encoding="utf-8")
+    skipped = []
+    assert records_of(path, skipped=skipped, chunk_size=chunk_size) == json.loads(path.read_text(encoding="utf-8"))
+    assert skipped == []
+
+
+def test_glued_records_and_compressed_files(tmp_path):
+    expected = cards(50)
+    path = tmp_path / "fidelity_complete.json.gz"
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        f.write("\n".join(json.dumps(card) for card in expected))
+    assert records_of(path) == expected
+
+
+def test_offsets_point_at_each_record(tmp_path):
+    path = tmp_path / "fidelity_complete.json"
+    path.write_text(json.dumps(cards(20)), encoding="utf-8")
+    data = path.read_bytes()
+    for offset, record in server.iter_tolerant_records(str(path)):
+        assert data[offset:offset + 1] == b"{"
+        assert json.JSONDecoder().raw_decode(data[offset:].decode())[0] == record
+
+
+def test_export_breakages_are_repaired(tmp_path):
+    path = tmp_path / "fidelity_complete.json"
+    path.write_text(
+        '[\n'
+        '\t{\n\t\t"card_number" : "1",\n\t\t"indirizzo" : "S.\\ MARIA"\n\t},\n'
+        '\t{\n\t\t"card_number" : "2",\n\t\t"indirizzo" : "VIA ROMA\\",\n\t\t"cap" : "70010"\n\t},\n'
+        '\t{\n\t\t"card_number" : "3",\n\t\t"ragione_sociale" : "",\n\t},\n'
+        '\t{\n\t\t"card_number" : "4",\n\t\t"nome" : "NICOLÒ"\n\t}\n'
+        ']\n',
+        encoding="utf-8",
+    )
+    skipped = []
+    assert records_of(path, skipped=skipped) == [
+        {"card_number": "1", "indirizzo": "S.\\ MARIA"},
+        {"card_number": "2", "indirizzo": "VIA ROMA", "cap": "70010"},
+        {"card_number": "3", "ragione_sociale": ""},
+        {"card_number": "4", "nome": "NICOLÒ"},
+    ]
+    assert skipped == []
+
+
+def test_latin1_records_fall_back(tmp_path):
+    path = tmp_path / "fidelity_complete.json"
+    path.write_bytes('[{"card_number": "1", "nome": "NICOLÒ"}]'.encode("latin-1"))
+    assert records_of(path) == [{"card_number": "1", "nome": "NICOLÒ"}]
+
+
+def test_unrepairable_records_are_skipped_and_reported(tmp_path):
+    path = tmp_path / "fidelity_complete.json"
+    path.write_text('[{"card_number": "1", "x": {broken}, {"card_number": "2"}]', encoding="utf-8")
+    skipped = []
+    assert records_of(path, skipped=skipped) == [{"card_number": "2"}]
+    assert [skip["offset"] for skip in skipped] == [1, 27]